@@ -1,15 +1,40 @@
 from flask import Flask, json, render_template, request, session, jsonify, flash, redirect, url_for, Blueprint
 from flask_session import Session
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta, time as dtime
+from contextlib import contextmanager
 import os
+import gzip
+import threading
+from collections import OrderedDict
+from time import monotonic
 import stripe
+from flask.json.provider import DefaultJSONProvider
 from config import STRIPE_PUBLIC_KEY, STRIPE_SECRET_KEY
 from psycopg2.extras import Json
 
+# Encoder JSON e compressione brotli sono opzionali: senza, si torna a
+# json della libreria standard e al solo gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # la chiave segreta di cicciariell va inserita qui
 stripe.api_key = STRIPE_SECRET_KEY
 
@@ -34,11 +59,124 @@ app.config["SESSION_FILE_DIR"] = SESSION_FOLDER
 
 Session(app)
 
+# Numero di proxy fidati davanti all'app (nginx, load balancer...): con 0 si
+# usa l'IP della connessione, altrimenti X-Forwarded-For/-Proto/-Host.
+# In modalità ASGI non combinarlo con "uvicorn --proxy-headers".
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES,
+                            x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
+
+# Redis condiviso tra i worker (opzionale): cache del riepilogo prenotazioni
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL and redis is not None else None
+
+# ======================
+# RISPOSTE API
+# ======================
+
+# Sotto questa soglia (byte) comprimere costa più di quanto si risparmia
+COMPRESSION_MIN_SIZE = 500
+COMPRESSION_MIMETYPES = {"application/json"}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Serializza con orjson (se installato) invece del modulo json, con lo
+    stesso output di Flask: chiavi ordinate, chiavi non stringa ammesse e
+    date nel formato HTTP (gestite da default()).
+    """
+
+    def _orjson_options(self):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.compact is False or (self.compact is None and self._app.debug):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        # Stessa semantica di jsonify(): un argomento, più argomenti o kwargs
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        if len(args) == 1:
+            obj = args[0]
+        else:
+            obj = args or kwargs or None
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self._orjson_options()),
+            mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+
+def choose_encoding(accept_encoding):
+    """
+    Sceglie, tra brotli (se disponibile) e gzip, la codifica accettata dal
+    client con il q più alto; q=0 esclude la codifica.
+    """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.lower()] = q
+
+    # "*" vale per gzip se gzip non è citato esplicitamente
+    candidates = {"gzip": accepted.get("gzip", accepted.get("*", 0))}
+    if brotli is not None:
+        candidates["br"] = accepted.get("br", 0)
+
+    # q più alto vince; a parità si preferisce brotli (comprime meglio)
+    encoding = max(candidates, key=lambda e: (candidates[e], e == "br"))
+    return encoding if candidates[encoding] > 0 else None
+
+
+def compress_body(body, accept_encoding):
+    """Restituisce (body, codifica); codifica è None se non si comprime."""
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return body, None
+    encoding = choose_encoding(accept_encoding)
+    if encoding == "br":
+        return brotli.compress(body, quality=5), encoding
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6), encoding
+    return body, None
+
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough
+            or response.mimetype not in COMPRESSION_MIMETYPES
+            or "Content-Encoding" in response.headers):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body, encoding = compress_body(
+        response.get_data(), request.headers.get("Accept-Encoding"))
+    if encoding:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    return response
+
 # ======================
 # DATABASE
 # ======================
 
-conn = psycopg2.connect(
+DB_PARAMS = dict(
     dbname="prenotazioni_db",
     user="postgres",
     password="1234",
@@ -46,8 +184,43 @@ conn = psycopg2.connect(
     port=5432
 )
 
+conn = psycopg2.connect(**DB_PARAMS)
+
 cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+# Connessioni dedicate per gli endpoint che devono avere una transazione
+# tutta loro (es. prenotazioni di gruppo): la connessione globale è condivisa
+# da tutti i thread, quindi commit/rollback di altre richieste la attraversano
+conn_pool = psycopg2.pool.ThreadedConnectionPool(1, 10, **DB_PARAMS)
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Connessione dedicata presa dal pool e restituita all'uscita.
+    Il pool non attende: se sono tutte occupate solleva PoolError.
+    """
+    pooled = conn_pool.getconn()
+    try:
+        yield pooled
+    finally:
+        conn_pool.putconn(pooled)
+
+
+def booking_lock_key(booking_date):
+    # Data normalizzata: "2026-11-3" e "2026-11-03" devono dare lo stesso lock
+    return f"bookings:{datetime.strptime(str(booking_date), '%Y-%m-%d').date()}"
+
+
+def lock_booking_date(cur, booking_date):
+    """
+    Lock transazionale sul giorno: tutte le scritture di prenotazioni (singole,
+    di gruppo, ASGI) sullo stesso giorno si serializzano fino al commit, così
+    nessuna si infila tra il controllo degli slot e l'inserimento di un'altra.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                (booking_lock_key(booking_date),))
+
 # ======================
 # TABELLE
 # ======================
@@ -123,6 +296,13 @@ END
 $$;
 """)
 
+# Indice coprente per lo storico per utente: le query di /api/bookings e
+# /api/bookings/history leggono solo dall'indice (index-only scan)
+cursor.execute("""
+CREATE INDEX IF NOT EXISTS idx_bookings_user_date
+ON bookings (user_id, booking_date, booking_time) INCLUDE (status);
+""")
+
 # Ordini (per prodotti comprati) con indirizzo
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS orders (
@@ -177,9 +357,7 @@ def skin_care():
 @app.route("/carrello")
 def carrello():
     cart = get_cart()
-    total_items = sum(item["quantity"] for item in cart)
-    total_price = round(
-        sum(item["price"] * item["quantity"] for item in cart), 2)
+    total_items, total_price = cart_totals(cart)
     return render_template(
         "carrello.html",
         cart=cart,
@@ -202,19 +380,19 @@ def save_cart(cart):
     session.modified = True
 
 
-@app.route("/api/cart/add", methods=["POST"])
-def add_to_cart():
-    data = request.json
-    product_id = str(data.get("id"))
-    name = str(data.get("name"))
-    price = float(data.get("price"))
+# Operazioni pure sul carrello: condivise tra le view Flask e la modalità ASGI
+def cart_totals(cart):
+    total_items = sum(item["quantity"] for item in cart)
+    total_price = round(sum(item["price"] * item["quantity"]
+                        for item in cart), 2)
+    return total_items, total_price
 
-    cart = get_cart()
+
+def cart_add_item(cart, product_id, name, price):
     for item in cart:
         if item["id"] == product_id:
             item["quantity"] += 1
-            save_cart(cart)
-            return jsonify(cart)
+            return cart
 
     cart.append({
         "id": product_id,
@@ -222,6 +400,29 @@ def add_to_cart():
         "price": price,
         "quantity": 1
     })
+    return cart
+
+
+def cart_update_item(cart, product_id, delta):
+    for item in cart:
+        if item["id"] == product_id:
+            item["quantity"] += delta
+            break
+    return [item for item in cart if item["quantity"] > 0]
+
+
+def cart_remove_item(cart, product_id):
+    return [item for item in cart if item["id"] != product_id]
+
+
+@app.route("/api/cart/add", methods=["POST"])
+def add_to_cart():
+    data = request.json
+    product_id = str(data.get("id"))
+    name = str(data.get("name"))
+    price = float(data.get("price"))
+
+    cart = cart_add_item(get_cart(), product_id, name, price)
     save_cart(cart)
     return jsonify(cart)
 
@@ -231,12 +432,7 @@ def update_cart():
     data = request.json
     product_id = str(data.get("id"))
     delta = int(data.get("delta"))
-    cart = get_cart()
-    for item in cart:
-        if item["id"] == product_id:
-            item["quantity"] += delta
-            break
-    cart = [item for item in cart if item["quantity"] > 0]
+    cart = cart_update_item(get_cart(), product_id, delta)
     save_cart(cart)
     return jsonify(cart)
 
@@ -245,12 +441,9 @@ def update_cart():
 def remove_from_cart():
     data = request.get_json(silent=True)
     product_id = str(data.get("id"))
-    cart = get_cart()
-    new_cart = [item for item in cart if item["id"] != product_id]
+    new_cart = cart_remove_item(get_cart(), product_id)
     save_cart(new_cart)
-    total_items = sum(item["quantity"] for item in new_cart)
-    total_price = round(sum(item["price"] * item["quantity"]
-                        for item in new_cart), 2)
+    total_items, total_price = cart_totals(new_cart)
     return jsonify({
         "success": True,
         "cart": new_cart,
@@ -380,9 +573,166 @@ def success():
 # ======================
 
 
+# ======================
+# RATE LIMITING
+# ======================
+# Token bucket per IP, per username e per (username, IP) su login/registrazione:
+# le richieste in eccesso vengono respinte PRIMA di generate/check_password_hash,
+# che sono le operazioni costose. Il bucket (username, IP) è quello stretto;
+# quello del solo username è largo, ma ferma gli attacchi distribuiti su molti
+# IP contro un singolo account senza permettere di bloccare un cliente con
+# poche richieste.
+# L'IP è request.remote_addr: dietro un proxy impostare TRUSTED_PROXIES (vedi
+# CONFIG), altrimenti tutti i client avrebbero l'IP del proxy.
+# Con RATE_LIMIT_REDIS_URL i bucket e i contatori sono condivisi tra processi
+# e server; altrimenti restano in memoria nel singolo processo.
+
+# (capacità, token ricaricati al secondo)
+RATE_LIMITS = {
+    ("login", "ip"): (20, 20 / 60),
+    ("login", "username"): (30, 30 / 600),
+    ("login", "username_ip"): (5, 5 / 60),
+    ("register", "ip"): (5, 5 / 600),
+}
+
+
+class MemoryTokenBuckets:
+    # Limite rigido: oltre, si scarta il bucket usato meno di recente (LRU)
+    MAX_KEYS = 100_000
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._throttled = {key: 0 for key in RATE_LIMITS}
+
+    def consume(self, key, capacity, rate):
+        """Consuma un token; restituisce (consentito, secondi prima del prossimo token)."""
+        now = monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def record_throttled(self, endpoint, scope):
+        with self._lock:
+            self._throttled[(endpoint, scope)] += 1
+
+    def throttled_counts(self):
+        with self._lock:
+            return {f"{endpoint}.{scope}": count
+                    for (endpoint, scope), count in self._throttled.items()}
+
+
+class RedisTokenBuckets:
+    # Lettura, ricarica e consumo in un unico script: atomico tra più processi
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+    METRICS_KEY = "barber_ratelimit_metrics"
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate):
+        try:
+            allowed, tokens = self._script(
+                keys=[f"barber_ratelimit:{key}"], args=[capacity, rate, datetime.now().timestamp()])
+        except redis.RedisError:
+            # Redis irraggiungibile: meglio lasciar passare che bloccare il login
+            return True, 0
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+    def record_throttled(self, endpoint, scope):
+        try:
+            self._client.hincrby(self.METRICS_KEY, f"{endpoint}.{scope}", 1)
+        except redis.RedisError:
+            pass
+
+    def throttled_counts(self):
+        counts = {f"{endpoint}.{scope}": 0 for endpoint, scope in RATE_LIMITS}
+        for field, count in self._client.hgetall(self.METRICS_KEY).items():
+            counts[field.decode()] = int(count)
+        return counts
+
+
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL")
+if RATE_LIMIT_REDIS_URL and redis is not None:
+    rate_limit_buckets = RedisTokenBuckets(RATE_LIMIT_REDIS_URL)
+else:
+    rate_limit_buckets = MemoryTokenBuckets()
+
+
+def check_rate_limit(endpoint, **identities):
+    """
+    Consuma un token per ciascuna identità (es. ip=..., username=...).
+    Restituisce None se la richiesta può procedere, altrimenti la risposta 429.
+    """
+    retry_after = 0
+    for scope, value in identities.items():
+        if not value:
+            continue
+        capacity, rate = RATE_LIMITS[(endpoint, scope)]
+        allowed, wait = rate_limit_buckets.consume(
+            f"{endpoint}:{scope}:{value}", capacity, rate)
+        if not allowed:
+            rate_limit_buckets.record_throttled(endpoint, scope)
+            retry_after = max(retry_after, wait)
+
+    if retry_after:
+        return "Troppe richieste, riprova più tardi", 429, {"Retry-After": str(int(retry_after) + 1)}
+    return None
+
+
+@app.route("/api/metrics/rate_limit", methods=["GET"])
+def rate_limit_metrics_api():
+    if session.get("role") != "admin":
+        return jsonify({"error": "Non autorizzato"}), 403
+    shared = isinstance(rate_limit_buckets, RedisTokenBuckets)
+    if shared:
+        try:
+            throttled = rate_limit_buckets.throttled_counts()
+        except redis.RedisError:
+            return jsonify({"error": "Metriche non disponibili"}), 503
+    else:
+        throttled = rate_limit_buckets.throttled_counts()
+    return jsonify({
+        "backend": "redis" if shared else "memory",
+        # "cluster": somma di tutti i processi; "process": solo questo worker
+        "scope": "cluster" if shared else "process",
+        "throttled": throttled
+    })
+
+
 @app.route("/api/register", methods=["POST"])
 @app.route("/register", methods=["POST"])
 def register():
+    throttled = check_rate_limit("register", ip=request.remote_addr)
+    if throttled:
+        return throttled
+
     data = request.get_json()
     username = data.get("username")
     password = data.get("password")
@@ -403,6 +753,13 @@ def register():
 @app.route("/login", methods=["POST"])
 def login():
     data = request.get_json()
+    username = data.get("username")
+    throttled = check_rate_limit(
+        "login", ip=request.remote_addr, username=username,
+        username_ip=f"{username}@{request.remote_addr}" if username else None)
+    if throttled:
+        return throttled
+
     cursor.execute("SELECT * FROM users WHERE username=%s",
                    (data.get("username"),))
     user = cursor.fetchone()
@@ -449,6 +806,7 @@ def get_bookings():
     cursor.execute("""
         SELECT booking_date, booking_time
         FROM bookings WHERE user_id=%s
+        ORDER BY booking_date, booking_time
     """, (session["user_id"],))
     rows = cursor.fetchall()
     return jsonify([{
@@ -457,6 +815,160 @@ def get_bookings():
     } for r in rows])
 
 
+# ======================
+# STORICO PRENOTAZIONI
+# ======================
+
+BOOKING_HISTORY_DEFAULT_LIMIT = 10
+BOOKING_HISTORY_MAX_LIMIT = 50
+
+# Una prenotazione conta solo se attiva; "prossima" = data+ora non ancora passata.
+# La condizione su booking_date permette il range scan sull'indice coprente.
+ACTIVE_BOOKING_SQL = "status IN ('pending','paid')"
+UPCOMING_BOOKING_SQL = (
+    "booking_date >= CURRENT_DATE AND booking_date + booking_time >= LOCALTIMESTAMP")
+
+# Riepilogo per utente (prossimo appuntamento, conteggi), invalidato a ogni
+# scrittura sulle prenotazioni dell'utente. Con REDIS_URL la cache è condivisa
+# da tutti i worker; senza, ogni processo ha la sua e l'invalidazione vale solo
+# lì: il TTL breve limita a pochi secondi un riepilogo vecchio sugli altri.
+BOOKING_SUMMARY_TTL = 300 if redis_client is not None else 10
+# Come i token bucket: LRU con limite rigido, le voci scadute si buttano in lettura
+BOOKING_SUMMARY_MAX_USERS = 10_000
+_booking_summary_cache = OrderedDict()
+_booking_summary_lock = threading.Lock()
+
+
+def _summary_key(user_id):
+    return f"barber_summary:{user_id}"
+
+
+def invalidate_booking_summary(user_id):
+    if user_id is None:
+        return
+    if redis_client is not None:
+        try:
+            redis_client.delete(_summary_key(user_id))
+        except redis.RedisError:
+            pass  # la voce scade comunque con il TTL
+        return
+    with _booking_summary_lock:
+        _booking_summary_cache.pop(user_id, None)
+
+
+def _cached_booking_summary(user_id):
+    if redis_client is not None:
+        try:
+            cached = redis_client.get(_summary_key(user_id))
+        except redis.RedisError:
+            return None
+        return json.loads(cached) if cached else None
+    with _booking_summary_lock:
+        cached = _booking_summary_cache.get(user_id)
+        if cached is None:
+            return None
+        if cached[0] <= monotonic():
+            del _booking_summary_cache[user_id]
+            return None
+        _booking_summary_cache.move_to_end(user_id)
+        return cached[1]
+
+
+def _store_booking_summary(user_id, summary, ttl):
+    if redis_client is not None:
+        try:
+            redis_client.setex(_summary_key(user_id), ttl, json.dumps(summary))
+        except redis.RedisError:
+            pass
+        return
+    with _booking_summary_lock:
+        _booking_summary_cache[user_id] = (monotonic() + ttl, summary)
+        _booking_summary_cache.move_to_end(user_id)
+        if len(_booking_summary_cache) > BOOKING_SUMMARY_MAX_USERS:
+            _booking_summary_cache.popitem(last=False)
+
+
+def get_booking_summary(user_id):
+    summary = _cached_booking_summary(user_id)
+    if summary is not None:
+        return summary
+
+    cursor.execute(f"""
+        SELECT COUNT(*) AS total_count,
+               COUNT(*) FILTER (WHERE {UPCOMING_BOOKING_SQL}) AS upcoming_count,
+               MIN(booking_date + booking_time) FILTER (
+                   WHERE {UPCOMING_BOOKING_SQL}
+               ) AS next_at
+        FROM bookings WHERE user_id=%s AND {ACTIVE_BOOKING_SQL}
+    """, (user_id,))
+    row = cursor.fetchone()
+    next_at = row["next_at"]
+    summary = {
+        "next_appointment": {
+            "booking_date": str(next_at.date()),
+            "booking_time": next_at.strftime("%H:%M")
+        } if next_at else None,
+        "upcoming_count": row["upcoming_count"],
+        "total_count": row["total_count"]
+    }
+
+    # Il riepilogo non deve sopravvivere al prossimo appuntamento
+    ttl = BOOKING_SUMMARY_TTL
+    if next_at:
+        ttl = max(1, min(ttl, int((next_at - datetime.now()).total_seconds())))
+    _store_booking_summary(user_id, summary, ttl)
+    return summary
+
+
+@app.route("/api/bookings/history", methods=["GET"])
+def booking_history():
+    """
+    Storico dell'utente loggato (solo prenotazioni attive): prossimi
+    appuntamenti (in ordine crescente), passati (dal più recente) e
+    riepilogo. ?limit= limita entrambe le liste.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Non autenticato"}), 401
+
+    try:
+        limit = int(request.args.get("limit", BOOKING_HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Limite non valido"}), 400
+    limit = max(1, min(limit, BOOKING_HISTORY_MAX_LIMIT))
+
+    cursor.execute(f"""
+        SELECT booking_date, booking_time, status
+        FROM bookings
+        WHERE user_id=%s AND {ACTIVE_BOOKING_SQL} AND {UPCOMING_BOOKING_SQL}
+        ORDER BY booking_date, booking_time
+        LIMIT %s
+    """, (user_id, limit))
+    upcoming = cursor.fetchall()
+
+    cursor.execute(f"""
+        SELECT booking_date, booking_time, status
+        FROM bookings
+        WHERE user_id=%s AND {ACTIVE_BOOKING_SQL} AND NOT ({UPCOMING_BOOKING_SQL})
+        ORDER BY booking_date DESC, booking_time DESC
+        LIMIT %s
+    """, (user_id, limit))
+    past = cursor.fetchall()
+
+    def serialize(rows):
+        return [{
+            "booking_date": str(r["booking_date"]),
+            "booking_time": str(r["booking_time"])[:5],
+            "status": r["status"]
+        } for r in rows]
+
+    return jsonify({
+        "summary": get_booking_summary(user_id),
+        "upcoming": serialize(upcoming),
+        "past": serialize(past)
+    })
+
+
 @app.route("/api/bookings", methods=["POST"])
 @app.route("/bookings", methods=["POST"])
 def create_booking():
@@ -474,80 +986,168 @@ def create_booking():
     if not service_id or not booking_date or not booking_time:
         return "Dati mancanti", 400
 
-    # Controllo durata servizio
-    cursor.execute(
-        "SELECT duration FROM services WHERE id=%s", (service_id,))
-    service = cursor.fetchone()
-    if not service:
-        return "Servizio non valido", 400
+    try:
+        with pooled_connection() as booking_conn, booking_conn, \
+                booking_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            # Controllo durata servizio
+            cur.execute(
+                "SELECT duration FROM services WHERE id=%s", (service_id,))
+            service = cur.fetchone()
+            if not service:
+                return "Servizio non valido", 400
+
+            service_duration = service["duration"]
+
+            # Controllo durata extra
+            extra_duration = 0
+            if extras:
+                extras_tuple = tuple(map(int, extras))
+                cur.execute(
+                    "SELECT COALESCE(SUM(duration),0) as total FROM extras WHERE id = ANY(%s)",
+                    (list(extras_tuple),)
+                )
+                extra_duration = cur.fetchone()["total"]
+
+            total_duration = service_duration + extra_duration
+
+            # Controllo slot liberi
+            h, m = booking_time.split(":")
+            start_minutes = int(h) * 60 + int(m)
+            end_minutes = start_minutes + total_duration
+
+            lock_booking_date(cur, booking_date)
+            cur.execute("""
+                SELECT booking_time, s.duration, b.extras
+                FROM bookings b
+                JOIN services s ON b.service_id = s.id
+                WHERE booking_date=%s
+                  AND status IN ('pending','paid')
+            """, (booking_date,))
+
+            bookings = cur.fetchall()
+
+            for b in bookings:
+                b_start = b["booking_time"].hour * 60 + b["booking_time"].minute
+                b_duration = b["duration"]
+
+                b_extra_duration = 0
+                if b["extras"]:
+                    extras_ids = [int(x) for x in b["extras"].split(",") if x]
+                    if extras_ids:
+                        cur.execute(
+                            "SELECT COALESCE(SUM(duration),0) as total FROM extras WHERE id = ANY(%s)",
+                            (extras_ids,)
+                        )
+                        b_extra_duration = cur.fetchone()["total"]
+
+                b_end = b_start + b_duration + b_extra_duration
+
+                if max(start_minutes, b_start) < min(end_minutes, b_end):
+                    return "Slot non disponibile", 400
+
+            # Inserimento prenotazione
+            cur.execute("""
+                INSERT INTO bookings (user_id, service_id, extras, booking_date, booking_time, status)
+                VALUES (%s,%s,%s,%s,%s,'pending')
+            """, (
+                session["user_id"],
+                service_id,
+                ",".join(map(str, extras)) if extras else None,
+                booking_date,
+                booking_time
+            ))
+    except psycopg2.pool.PoolError:
+        return "Servizio momentaneamente non disponibile, riprova", 503
+    except psycopg2.errors.UniqueViolation:
+        return "Slot non disponibile", 400
+
+    invalidate_booking_summary(session["user_id"])
+    return "Prenotazione confermata", 200
 
-    service_duration = service["duration"]
 
-    # Controllo durata extra
-    extra_duration = 0
-    if extras:
-        extras_tuple = tuple(map(int, extras))
-        cursor.execute(
-            "SELECT COALESCE(SUM(duration),0) as total FROM extras WHERE id = ANY(%s)",
-            (list(extras_tuple),)
-        )
-        extra_duration = cursor.fetchone()["total"]
+# ======================
+# API SLOT DISPONIBILI
+# ======================
 
-    total_duration = service_duration + extra_duration
+# Griglia degli slot: ogni 15 min dalle 10 alle 20
+SLOT_START_HOUR = 10
+SLOT_END_HOUR = 20
+SLOT_STEP_MINUTES = 15
 
-    # Controllo slot liberi
-    h, m = booking_time.split(":")
-    start_minutes = int(h) * 60 + int(m)
-    end_minutes = start_minutes + total_duration
 
-    cursor.execute("""
-        SELECT booking_time, s.duration, b.extras
-        FROM bookings b
-        JOIN services s ON b.service_id = s.id
-        WHERE booking_date=%s
-          AND status IN ('pending','paid')
-    """, (booking_date,))
+def all_slot_minutes():
+    return list(range(SLOT_START_HOUR * 60, SLOT_END_HOUR * 60, SLOT_STEP_MINUTES))
 
-    bookings = cursor.fetchall()
 
-    for b in bookings:
-        b_start = b["booking_time"].hour * 60 + b["booking_time"].minute
-        b_duration = b["duration"]
+def format_slot(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
 
-        b_extra_duration = 0
-        if b["extras"]:
-            extras_ids = [int(x) for x in b["extras"].split(",") if x]
-            if extras_ids:
-                cursor.execute(
-                    "SELECT COALESCE(SUM(duration),0) as total FROM extras WHERE id = ANY(%s)",
-                    (extras_ids,)
-                )
-                b_extra_duration = cursor.fetchone()["total"]
 
-        b_end = b_start + b_duration + b_extra_duration
+def encode_slots_compact(slot_minutes):
+    """
+    Codifica compatta di una lista di slot: minuto di inizio del primo slot
+    e bitmask in cui il bit i indica lo slot start + i * SLOT_STEP_MINUTES.
+    La griglia ha 40 slot, quindi la maschera resta un intero sicuro in JS.
+    """
+    if not slot_minutes:
+        return {"start": None, "step": SLOT_STEP_MINUTES, "mask": 0}
+    start = slot_minutes[0]
+    mask = 0
+    for minutes in slot_minutes:
+        mask |= 1 << ((minutes - start) // SLOT_STEP_MINUTES)
+    return {"start": start, "step": SLOT_STEP_MINUTES, "mask": mask}
+
 
-        if max(start_minutes, b_start) < min(end_minutes, b_end):
-            return "Slot non disponibile", 400
+def parse_extras_ids(raw):
+    """Id degli extra salvati in bookings.extras come "1,2,3"."""
+    try:
+        return [int(x) for x in raw.split(",") if x] if raw else []
+    except ValueError:
+        return []  # se formato non corretto, ignora
 
-    # Inserimento prenotazione
-    cursor.execute("""
-        INSERT INTO bookings (user_id, service_id, extras, booking_date, booking_time, status)
-        VALUES (%s,%s,%s,%s,%s,'pending')
-    """, (
-        session["user_id"],
-        service_id,
-        ",".join(map(str, extras)) if extras else None,
-        booking_date,
-        booking_time
-    ))
-
-    conn.commit()
-    return "Prenotazione confermata", 200
 
+def extras_duration(extras_ids, extra_durations):
+    # Ogni extra conta una volta sola, come il vecchio SUM ... WHERE id IN
+    return sum(extra_durations.get(e, 0) for e in set(extras_ids))
+
+
+def busy_intervals(rows, extra_durations):
+    """
+    Intervalli (inizio, fine) in minuti delle prenotazioni esistenti, nello
+    stesso ordine di rows (booking_time, duration, extras).
+    extra_durations: {id extra: durata}, vedi extras_ids_of().
+    """
+    intervals = []
+    for b in rows:
+        b_start = b["booking_time"].hour * 60 + b["booking_time"].minute
+        b_end = b_start + b["duration"] + \
+            extras_duration(parse_extras_ids(b["extras"]), extra_durations)
+        intervals.append((b_start, b_end))
+    return intervals
+
+
+def extras_ids_of(rows):
+    """Tutti gli id extra citati da rows, per caricarne le durate in una query."""
+    return set().union(*(parse_extras_ids(b["extras"]) for b in rows))
+
+
+def free_slot_minutes(total_duration, existing_bookings):
+    """
+    Minuti di inizio degli slot che non si sovrappongono a nessuno degli
+    intervalli (inizio, fine) in existing_bookings.
+    """
+    available = []
+    for start_min in all_slot_minutes():
+        end_min = start_min + total_duration
+        conflict = False
+        for b_start, b_end in existing_bookings:
+            if max(start_min, b_start) < min(end_min, b_end):
+                conflict = True
+                break
+        if not conflict:
+            available.append(start_min)
+    return available
 
-# ======================
-# API SLOT DISPONIBILI
-# ======================
 
 # ======================
 # API SLOT DISPONIBILI OTTIMIZZATA
@@ -580,28 +1180,12 @@ def available_slots():
 
     service_duration = service_row["duration"]
 
-    # Calcolo durata extras
-    extra_duration = 0
-    extras_ids = []
-    if extras:
-        try:
-            extras_ids = [int(e) for e in extras]
-            if extras_ids:
-                cursor.execute(
-                    "SELECT COALESCE(SUM(duration),0) AS total FROM extras WHERE id IN %s",
-                    (tuple(extras_ids),)
-                )
-                extra_duration = cursor.fetchone()["total"] or 0
-        except ValueError:
-            return jsonify({"error": "ID extra non valido"}), 400
-
-    total_duration = service_duration + extra_duration
-
-    # ------------- 3. Tutti gli slot possibili (ogni 15 min dalle 10 alle 20) -------------
-    all_slots = [f"{h:02d}:{m:02d}" for h in range(10, 20) for m in [
-        0, 15, 30, 45]]
+    try:
+        extras_ids = [int(e) for e in extras]
+    except ValueError:
+        return jsonify({"error": "ID extra non valido"}), 400
 
-    # ------------- 4. Prenotazioni esistenti -------------
+    # ------------- 3. Prenotazioni esistenti -------------
     cursor.execute("""
         SELECT b.booking_time, s.duration, b.extras
         FROM bookings b
@@ -610,133 +1194,308 @@ def available_slots():
     """, (date,))
     bookings = cursor.fetchall()
 
-    # Pre-calcolo durata totale delle prenotazioni esistenti
-    existing_bookings = []
-    for b in bookings:
-        b_start = b["booking_time"].hour * 60 + b["booking_time"].minute
-        b_duration = b["duration"]
-
-        b_extra_duration = 0
-        if b["extras"]:
-            try:
-                b_extras_ids = [int(x) for x in b["extras"].split(",") if x]
-                if b_extras_ids:
-                    cursor.execute(
-                        "SELECT COALESCE(SUM(duration),0) AS total FROM extras WHERE id IN %s",
-                        (tuple(b_extras_ids),)
-                    )
-                    b_extra_duration = cursor.fetchone()["total"] or 0
-            except Exception:
-                pass  # se formato non corretto, ignora
-
-        b_end = b_start + b_duration + b_extra_duration
-        existing_bookings.append((b_start, b_end))
-
-    # ------------- 5. Filtra slot disponibili -------------
-    available = []
-    for slot in all_slots:
-        start_min = int(slot.split(":")[0])*60 + int(slot.split(":")[1])
-        end_min = start_min + total_duration
+    # Durate di tutti gli extra coinvolti (richiesti e già prenotati) in un'unica query
+    extra_durations = {}
+    wanted = set(extras_ids) | extras_ids_of(bookings)
+    if wanted:
+        cursor.execute(
+            "SELECT id, duration FROM extras WHERE id = ANY(%s)", (list(wanted),))
+        extra_durations = {r["id"]: r["duration"] for r in cursor.fetchall()}
 
-        conflict = False
-        for b_start, b_end in existing_bookings:
-            if max(start_min, b_start) < min(end_min, b_end):
-                conflict = True
-                break
+    total_duration = service_duration + \
+        extras_duration(extras_ids, extra_durations)
+    existing_bookings = busy_intervals(bookings, extra_durations)
 
-        if not conflict:
-            available.append(slot)
+    # ------------- 4. Filtra slot disponibili -------------
+    available = free_slot_minutes(total_duration, existing_bookings)
 
-    return jsonify({"slots": available})
+    # ?format=compact -> inizio + bitmask invece della lista di "HH:MM"
+    if request.args.get("format") == "compact":
+        return jsonify(encode_slots_compact(available))
+    return jsonify({"slots": [format_slot(m) for m in available]})
 
 
-@app.route("/api/bookings/checkout", methods=["POST"])
-def booking_checkout():
-    data = request.get_json()
+def parse_booking_checkout(data):
+    """
+    Valida il payload di /api/bookings/checkout.
+    Restituisce (dati, None) oppure (None, messaggio di errore).
+    """
     if not data:
-        return jsonify({"error": "Dati mancanti"}), 400
-
-    # Prendo i dati dal client
-    service_name = data.get("service_name")
-    service_price = data.get("service_price")
-    booking_date = data.get("booking_date")
-    booking_time = data.get("booking_time")
-    customer_name = data.get("customer_name")
-    customer_email = data.get("customer_email")
-    service_id = data.get("service_id")  # necessario per controllare lo slot
-    user_id = session.get("user_id")  # opzionale, None se non loggato
+        return None, "Dati mancanti"
+
+    fields = {
+        "service_name": data.get("service_name"),
+        "service_price": data.get("service_price"),
+        "booking_date": data.get("booking_date"),
+        "booking_time": data.get("booking_time"),
+        "customer_name": data.get("customer_name"),
+        "customer_email": data.get("customer_email"),
+        "service_id": data.get("service_id"),  # necessario per controllare lo slot
+    }
 
     # Validazioni base
-    if not all([service_name, service_price, booking_date, booking_time, customer_name, customer_email, service_id]):
-        return jsonify({"error": "Dati cliente mancanti o non validi"}), 400
+    if not all(fields.values()):
+        return None, "Dati cliente mancanti o non validi"
 
     try:
-        service_price = float(service_price)
-        service_id = int(service_id)
-        if service_price < 0:
+        fields["service_price"] = float(fields["service_price"])
+        fields["service_id"] = int(fields["service_id"])
+        if fields["service_price"] < 0:
             raise ValueError
     except ValueError:
-        return jsonify({"error": "Prezzo o ID servizio non valido"}), 400
+        return None, "Prezzo o ID servizio non valido"
 
-    try:
-        # 1. Controllo se lo slot è già occupato
-        cursor.execute("""
-            SELECT 1 FROM bookings
-            WHERE booking_date = %s
-              AND booking_time = %s
-              AND service_id = %s
-              AND status IN ('pending', 'paid')
-        """, (booking_date, booking_time, service_id))
+    return fields, None
 
-        if cursor.fetchone():
-            return jsonify({"error": "Slot già occupato"}), 400
 
-        # 2. Inserisco la prenotazione nel DB
-        cursor.execute("""
-            INSERT INTO bookings 
-            (user_id, service_id, booking_date, booking_time, customer_name, customer_email, status)
-            VALUES (%s, %s, %s, %s, %s, %s, 'pending')
-            RETURNING id
-        """, (user_id, service_id, booking_date, booking_time, customer_name, customer_email))
-        booking_id = cursor.fetchone()[0]
-        conn.commit()
+def booking_line_item(service_name, service_price):
+    return {
+        "price_data": {
+            "currency": "eur",
+            "product_data": {"name": service_name},
+            "unit_amount": int(service_price * 100),
+        },
+        "quantity": 1,
+    }
 
-        # 3. Creo sessione Stripe
-        stripe_session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            mode="payment",
-            customer_email=customer_email,
-            line_items=[{
-                "price_data": {
-                    "currency": "eur",
-                    "product_data": {"name": service_name},
-                    "unit_amount": int(service_price * 100),
-                },
-                "quantity": 1,
-            }],
-            success_url=url_for("booking_success", _external=True) +
-            "?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url=url_for("prenotazioni", _external=True)
-        )
 
-        # 4. Aggiorno la prenotazione con stripe_session_id
-        cursor.execute("""
-            UPDATE bookings
-            SET stripe_session_id = %s
-            WHERE id = %s
-        """, (stripe_session.id, booking_id))
-        conn.commit()
+@app.route("/api/bookings/checkout", methods=["POST"])
+def booking_checkout():
+    fields, error = parse_booking_checkout(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    service_name = fields["service_name"]
+    service_price = fields["service_price"]
+    booking_date = fields["booking_date"]
+    booking_time = fields["booking_time"]
+    customer_name = fields["customer_name"]
+    customer_email = fields["customer_email"]
+    service_id = fields["service_id"]
+    user_id = session.get("user_id")  # opzionale, None se non loggato
+
+    try:
+        # 1-2: controllo e inserimento su una connessione dedicata, con il lock
+        # del giorno; il commit avviene all'uscita del blocco, prima di Stripe
+        with pooled_connection() as booking_conn:
+            with booking_conn, booking_conn.cursor() as cur:
+                # 1. Controllo se lo slot è già occupato
+                lock_booking_date(cur, booking_date)
+                cur.execute("""
+                    SELECT 1 FROM bookings
+                    WHERE booking_date = %s
+                      AND booking_time = %s
+                      AND service_id = %s
+                      AND status IN ('pending', 'paid')
+                """, (booking_date, booking_time, service_id))
+
+                if cur.fetchone():
+                    return jsonify({"error": "Slot già occupato"}), 400
+
+                # 2. Inserisco la prenotazione nel DB
+                cur.execute("""
+                    INSERT INTO bookings
+                    (user_id, service_id, booking_date, booking_time, customer_name, customer_email, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, 'pending')
+                    RETURNING id
+                """, (user_id, service_id, booking_date, booking_time, customer_name, customer_email))
+                booking_id = cur.fetchone()[0]
+            invalidate_booking_summary(user_id)
+
+            # 3. Creo sessione Stripe (nessuna transazione aperta)
+            try:
+                stripe_session = stripe.checkout.Session.create(
+                    payment_method_types=["card"],
+                    mode="payment",
+                    customer_email=customer_email,
+                    line_items=[booking_line_item(service_name, service_price)],
+                    success_url=url_for("booking_success", _external=True) +
+                    "?session_id={CHECKOUT_SESSION_ID}",
+                    cancel_url=url_for("prenotazioni", _external=True)
+                )
+            except stripe.error.StripeError:
+                # Libero lo slot: l'indice unico lo terrebbe occupato anche
+                # con la prenotazione annullata
+                with booking_conn, booking_conn.cursor() as cur:
+                    cur.execute("DELETE FROM bookings WHERE id = %s", (booking_id,))
+                invalidate_booking_summary(user_id)
+                raise
+
+            # 4. Aggiorno la prenotazione con stripe_session_id
+            with booking_conn, booking_conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE bookings
+                    SET stripe_session_id = %s
+                    WHERE id = %s
+                """, (stripe_session.id, booking_id))
 
         return jsonify({"session_id": stripe_session.id})
 
+    except psycopg2.pool.PoolError:
+        return jsonify({"error": "Servizio momentaneamente non disponibile, riprova"}), 503
     except psycopg2.errors.UniqueViolation:
-        conn.rollback()
         return jsonify({"error": "Slot già occupato"}), 400
     except stripe.error.StripeError as e:
-        conn.rollback()
         return jsonify({"error": f"Errore Stripe: {str(e)}"}), 500
     except Exception as e:
-        conn.rollback()
+        return jsonify({"error": f"Errore server: {str(e)}"}), 500
+
+
+# Limite di prenotazioni in una singola richiesta di gruppo
+BATCH_BOOKING_MAX_SIZE = 10
+
+
+def time_to_minutes(value):
+    h, m = str(value).split(":")[:2]
+    return int(h) * 60 + int(m)
+
+
+@app.route("/api/bookings/checkout/batch", methods=["POST"])
+def booking_checkout_batch():
+    """
+    Prenotazione di gruppo: più slot (es. famiglia, uno dopo l'altro) con un
+    solo controllo degli orari, una sola transazione e una sola sessione
+    Stripe con una riga per prenotazione. Se uno slot non è libero non viene
+    salvata nessuna prenotazione; se Stripe fallisce vengono cancellate tutte.
+    """
+    data = request.get_json()
+    if not data or not isinstance(data.get("bookings"), list) or not data["bookings"]:
+        return jsonify({"error": "Dati mancanti"}), 400
+    if len(data["bookings"]) > BATCH_BOOKING_MAX_SIZE:
+        return jsonify({"error": f"Massimo {BATCH_BOOKING_MAX_SIZE} prenotazioni per richiesta"}), 400
+
+    customer_name = data.get("customer_name")
+    customer_email = data.get("customer_email")
+    user_id = session.get("user_id")  # opzionale, None se non loggato
+
+    # Ogni prenotazione usa la stessa validazione del checkout singolo
+    requested = []
+    for item in data["bookings"]:
+        fields, error = parse_booking_checkout({
+            **(item if isinstance(item, dict) else {}),
+            "customer_name": customer_name,
+            "customer_email": customer_email
+        })
+        if error:
+            return jsonify({"error": error}), 400
+        try:
+            fields["booking_date"] = datetime.strptime(
+                str(fields["booking_date"]), "%Y-%m-%d").date()
+            fields["start"] = time_to_minutes(fields["booking_time"])
+        except ValueError:
+            return jsonify({"error": "Data o orario non validi"}), 400
+        requested.append(fields)
+
+    try:
+        with pooled_connection() as batch_conn:
+            # 1-4: controllo e inserimento in un'unica transazione sulla connessione
+            # dedicata; il commit avviene all'uscita del blocco, prima di Stripe
+            with batch_conn, batch_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                # 1. Durate dei servizi richiesti, in un'unica query
+                service_ids = list({b["service_id"] for b in requested})
+                cur.execute(
+                    "SELECT id, duration FROM services WHERE id = ANY(%s)", (service_ids,))
+                durations = {r["id"]: r["duration"] for r in cur.fetchall()}
+                if len(durations) != len(service_ids):
+                    return jsonify({"error": "Servizio non valido"}), 400
+
+                dates = sorted({b["booking_date"] for b in requested})
+
+                # Stesso lock del checkout singolo: nessuna prenotazione sugli
+                # stessi giorni si infila tra controllo e commit
+                for booking_date in dates:
+                    lock_booking_date(cur, booking_date)
+
+                # 2. Occupazione di tutti i giorni coinvolti, in un'unica query
+                cur.execute("""
+                    SELECT b.booking_date, b.booking_time, s.duration, b.extras
+                    FROM bookings b
+                    JOIN services s ON b.service_id = s.id
+                    WHERE b.booking_date = ANY(%s::date[]) AND b.status IN ('pending','paid')
+                """, (dates,))
+                rows = cur.fetchall()
+
+                extra_durations = {}
+                wanted = extras_ids_of(rows)
+                if wanted:
+                    cur.execute(
+                        "SELECT id, duration FROM extras WHERE id = ANY(%s)", (list(wanted),))
+                    extra_durations = {r["id"]: r["duration"] for r in cur.fetchall()}
+
+                busy = {}
+                for r, interval in zip(rows, busy_intervals(rows, extra_durations)):
+                    busy.setdefault(r["booking_date"], []).append(interval)
+
+                # 3. Ogni intervallo richiesto contro l'occupazione del giorno, che
+                # include via via anche gli altri slot dello stesso gruppo
+                for b in requested:
+                    start = b["start"]
+                    end = start + durations[b["service_id"]]
+                    day_busy = busy.setdefault(b["booking_date"], [])
+                    for b_start, b_end in day_busy:
+                        if max(start, b_start) < min(end, b_end):
+                            return jsonify({
+                                "error": "Slot non disponibile",
+                                "booking_date": str(b["booking_date"]),
+                                "booking_time": b["booking_time"]
+                            }), 400
+                    day_busy.append((start, end))
+
+                # 4. Inserimento di tutte le prenotazioni (pending: gli slot restano
+                # occupati mentre il cliente paga)
+                booking_ids = []
+                for b in requested:
+                    cur.execute("""
+                        INSERT INTO bookings
+                        (user_id, service_id, booking_date, booking_time, customer_name, customer_email, status)
+                        VALUES (%s, %s, %s, %s, %s, %s, 'pending')
+                        RETURNING id
+                    """, (user_id, b["service_id"], b["booking_date"], b["booking_time"],
+                          customer_name, customer_email))
+                    booking_ids.append(cur.fetchone()[0])
+
+            invalidate_booking_summary(user_id)
+
+            # 5. Una sola sessione Stripe, una riga per prenotazione, senza
+            # transazioni aperte durante la chiamata HTTP
+            try:
+                stripe_session = stripe.checkout.Session.create(
+                    payment_method_types=["card"],
+                    mode="payment",
+                    customer_email=customer_email,
+                    line_items=[booking_line_item(
+                        f"{b['service_name']} ({b['booking_date']} {b['booking_time']})",
+                        b["service_price"]
+                    ) for b in requested],
+                    success_url=url_for("booking_success", _external=True) +
+                    "?session_id={CHECKOUT_SESSION_ID}",
+                    cancel_url=url_for("prenotazioni", _external=True)
+                )
+            except stripe.error.StripeError as e:
+                # Il gruppo fallisce in blocco: cancello le righe, perché
+                # unique_booking_slot non distingue lo status e una riga
+                # 'cancelled' terrebbe lo slot occupato per sempre
+                with batch_conn, batch_conn.cursor() as cur:
+                    cur.execute("DELETE FROM bookings WHERE id = ANY(%s)", (booking_ids,))
+                invalidate_booking_summary(user_id)
+                return jsonify({"error": f"Errore Stripe: {str(e)}"}), 500
+
+            with batch_conn, batch_conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE bookings
+                    SET stripe_session_id = %s
+                    WHERE id = ANY(%s)
+                """, (stripe_session.id, booking_ids))
+
+            return jsonify({"session_id": stripe_session.id, "booking_ids": booking_ids})
+
+    except psycopg2.pool.PoolError:
+        return jsonify({"error": "Servizio momentaneamente non disponibile, riprova"}), 503
+    except psycopg2.errors.UniqueViolation:
+        return jsonify({"error": "Slot già occupato"}), 400
+    except (psycopg2.errors.InvalidDatetimeFormat, psycopg2.errors.DatetimeFieldOverflow):
+        return jsonify({"error": "Data o orario non validi"}), 400
+    except Exception as e:
         return jsonify({"error": f"Errore server: {str(e)}"}), 500
 
 
@@ -755,8 +1514,12 @@ def booking_success():
             UPDATE bookings
             SET status = 'paid'
             WHERE stripe_session_id = %s
+            RETURNING user_id
         """, (session_id,))
+        paid_user_ids = {r["user_id"] for r in cursor.fetchall()}
         conn.commit()
+        for user_id in paid_user_ids:
+            invalidate_booking_summary(user_id)
 
         flash("Prenotazione confermata e pagata con successo!", "success")
     else:
@@ -0,0 +1,421 @@
+"""
+Modalità di servizio ASGI (asyncio) per l'app del barbershop.
+
+Gli endpoint JSON più trafficati (/api/available_slots, /api/cart/*,
+/api/bookings/checkout) sono serviti da Starlette sull'event loop, con
+asyncpg per Postgres e httpx per le chiamate a Stripe: un'attesa sul DB o
+su Stripe non occupa più un intero thread. Tutto il resto (pagine,
+template, login, ordini) continua a passare dall'app Flask montata come
+WSGI.
+
+Avvio:
+    uvicorn asgi:application --workers 4
+
+Dietro un reverse proxy impostare TRUSTED_PROXIES (vedi app.py): il rate
+limiting di login/registrazione è per IP del client.
+
+Dipendenze: vedi requirements.txt (starlette, uvicorn, asyncpg, httpx, a2wsgi).
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import date as ddate, time as dtime
+
+import asyncpg
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.test import EnvironBuilder
+
+from app import (
+    app as flask_app,
+    cart_add_item,
+    cart_remove_item,
+    cart_totals,
+    cart_update_item,
+    booking_line_item,
+    booking_lock_key,
+    busy_intervals,
+    compress_body,
+    encode_slots_compact,
+    extras_duration,
+    extras_ids_of,
+    format_slot,
+    free_slot_minutes,
+    invalidate_booking_summary,
+    parse_booking_checkout,
+    STRIPE_SECRET_KEY,
+)
+
+STRIPE_API_URL = "https://api.stripe.com/v1"
+
+# Risorse condivise, create all'avvio (lifespan)
+db_pool = None
+stripe_client = None
+
+
+# ======================
+# SESSIONE FLASK
+# ======================
+# Il carrello e l'utente loggato vivono nella sessione Flask (Flask-Session su
+# filesystem): la apriamo e la salviamo con la session_interface dell'app,
+# così le due modalità condividono lo stesso cookie e gli stessi dati.
+
+
+def build_environ(request, body=b""):
+    return EnvironBuilder(
+        path=request.url.path,
+        base_url=f"{request.url.scheme}://{request.url.netloc}",
+        query_string=request.url.query,
+        method=request.method,
+        headers=list(request.headers.items()),
+        data=body,
+    ).get_environ()
+
+
+def _open_session(environ):
+    flask_request = flask_app.request_class(environ)
+    return flask_app.session_interface.open_session(flask_app, flask_request)
+
+
+def _session_cookies(flask_session):
+    flask_response = flask_app.response_class()
+    flask_app.session_interface.save_session(
+        flask_app, flask_session, flask_response)
+    return flask_response.headers.getlist("Set-Cookie")
+
+
+async def open_session(environ):
+    # Lettura del file di sessione: la spostiamo fuori dall'event loop
+    return await asyncio.to_thread(_open_session, environ)
+
+
+async def session_response(request, flask_session, payload, status_code=200):
+    response = api_response(request, payload, status_code=status_code)
+    for cookie in await asyncio.to_thread(_session_cookies, flask_session):
+        response.headers.append("set-cookie", cookie)
+    return response
+
+
+def external_url(environ, endpoint):
+    adapter = flask_app.create_url_adapter(flask_app.request_class(environ))
+    return adapter.build(endpoint, force_external=True)
+
+
+# ======================
+# RISPOSTE API
+# ======================
+
+
+def api_response(request, payload, status_code=200):
+    """Stesso encoder JSON e stessa compressione della modalità Flask."""
+    body, encoding = compress_body(
+        flask_app.json.dumps(payload).encode(),
+        request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code=status_code, headers=headers,
+                    media_type="application/json")
+
+
+# ======================
+# STRIPE (HTTP ASINCRONO)
+# ======================
+
+
+def stripe_form(params, prefix=""):
+    """Codifica parametri annidati nel formato form di Stripe (a[b][0][c]=...)."""
+    items = []
+    if isinstance(params, dict):
+        for key, value in params.items():
+            items += stripe_form(value, f"{prefix}[{key}]" if prefix else key)
+    elif isinstance(params, (list, tuple)):
+        for i, value in enumerate(params):
+            items += stripe_form(value, f"{prefix}[{i}]")
+    else:
+        items.append((prefix, str(params)))
+    return items
+
+
+class StripeAsyncError(Exception):
+    pass
+
+
+async def stripe_create_checkout_session(**params):
+    response = await stripe_client.post(
+        "/checkout/sessions", data=stripe_form(params))
+    body = response.json()
+    if response.status_code >= 400:
+        raise StripeAsyncError(body.get("error", {}).get("message", "errore sconosciuto"))
+    return body
+
+
+# ======================
+# CART
+# ======================
+
+
+def parse_json_object(body):
+    """Corpo JSON della richiesta come dict, oppure None se malformato."""
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def invalid_cart_request(request):
+    return api_response(request, {"error": "Dati carrello non validi"}, status_code=400)
+
+
+async def add_to_cart(request):
+    body = await request.body()
+    data = parse_json_object(body)
+    try:
+        product_id = str(data["id"])
+        name = str(data.get("name"))
+        price = float(data.get("price"))
+    except (TypeError, KeyError, ValueError):
+        return invalid_cart_request(request)
+
+    flask_session = await open_session(build_environ(request, body))
+    cart = cart_add_item(flask_session.get("cart", []), product_id, name, price)
+    flask_session["cart"] = cart
+    flask_session.modified = True
+    return await session_response(request, flask_session, cart)
+
+
+async def update_cart(request):
+    body = await request.body()
+    data = parse_json_object(body)
+    try:
+        product_id = str(data["id"])
+        delta = int(data.get("delta"))
+    except (TypeError, KeyError, ValueError):
+        return invalid_cart_request(request)
+
+    flask_session = await open_session(build_environ(request, body))
+    cart = cart_update_item(flask_session.get("cart", []), product_id, delta)
+    flask_session["cart"] = cart
+    flask_session.modified = True
+    return await session_response(request, flask_session, cart)
+
+
+async def remove_from_cart(request):
+    body = await request.body()
+    data = parse_json_object(body)
+    try:
+        product_id = str(data["id"])
+    except (TypeError, KeyError):
+        return invalid_cart_request(request)
+
+    flask_session = await open_session(build_environ(request, body))
+    new_cart = cart_remove_item(flask_session.get("cart", []), product_id)
+    flask_session["cart"] = new_cart
+    flask_session.modified = True
+    total_items, total_price = cart_totals(new_cart)
+    return await session_response(request, flask_session, {
+        "success": True,
+        "cart": new_cart,
+        "total_items": total_items,
+        "total_price": total_price
+    })
+
+
+async def get_cart_api(request):
+    flask_session = await open_session(build_environ(request))
+    return await session_response(request, flask_session, flask_session.get("cart", []))
+
+
+# ======================
+# BOOKINGS
+# ======================
+
+
+# asyncpg vuole oggetti date/time, non stringhe
+def date_param(value):
+    return ddate.fromisoformat(value)
+
+
+def time_param(value):
+    return dtime.fromisoformat(value)
+
+
+async def available_slots(request):
+    # ------------- 1. Parametri -------------
+    service_id = request.query_params.get("service_id")
+    extras = request.query_params.getlist("extras[]")
+    date = request.query_params.get("date")
+
+    if not service_id or not date:
+        return api_response(request, {"error": "Parametri mancanti"}, status_code=400)
+
+    try:
+        service_id = int(service_id)
+    except ValueError:
+        return api_response(request, {"error": "ID servizio non valido"}, status_code=400)
+
+    try:
+        extras_ids = [int(e) for e in extras]
+    except ValueError:
+        return api_response(request, {"error": "ID extra non valido"}, status_code=400)
+
+    try:
+        booking_date = date_param(date)
+    except ValueError:
+        return api_response(request, {"error": "Data non valida"}, status_code=400)
+
+    async with db_pool.acquire() as db:
+        # ------------- 2. Durata totale -------------
+        service_duration = await db.fetchval(
+            "SELECT duration FROM services WHERE id=$1", service_id)
+        if service_duration is None:
+            return api_response(request, {"error": "Servizio non valido"}, status_code=400)
+
+        # ------------- 3. Prenotazioni esistenti -------------
+        bookings = await db.fetch("""
+            SELECT b.booking_time, s.duration, b.extras
+            FROM bookings b
+            JOIN services s ON b.service_id = s.id
+            WHERE b.booking_date=$1 AND b.status IN ('pending','paid')
+        """, booking_date)
+
+        # Durate di tutti gli extra coinvolti in un'unica query
+        extra_durations = {}
+        wanted = set(extras_ids) | extras_ids_of(bookings)
+        if wanted:
+            rows = await db.fetch(
+                "SELECT id, duration FROM extras WHERE id = ANY($1::int[])", list(wanted))
+            extra_durations = {r["id"]: r["duration"] for r in rows}
+
+    total_duration = service_duration + \
+        extras_duration(extras_ids, extra_durations)
+    existing_bookings = busy_intervals(bookings, extra_durations)
+
+    # ------------- 4. Filtra slot disponibili -------------
+    available = free_slot_minutes(total_duration, existing_bookings)
+
+    if request.query_params.get("format") == "compact":
+        return api_response(request, encode_slots_compact(available))
+    return api_response(request, {"slots": [format_slot(m) for m in available]})
+
+
+async def booking_checkout(request):
+    body = await request.body()
+    fields, error = parse_booking_checkout(parse_json_object(body))
+    if error:
+        return api_response(request, {"error": error}, status_code=400)
+
+    environ = build_environ(request, body)
+    flask_session = await open_session(environ)
+    user_id = flask_session.get("user_id")  # opzionale, None se non loggato
+
+    try:
+        booking_date = date_param(fields["booking_date"])
+        booking_time = time_param(fields["booking_time"])
+    except ValueError:
+        return api_response(request, {"error": "Data o orario non validi"}, status_code=400)
+
+    async with db_pool.acquire() as db:
+        try:
+            # 1. Controllo slot + inserimento prenotazione
+            async with db.transaction():
+                # Stesso lock per giorno delle altre vie di prenotazione (app.py)
+                await db.execute("SELECT pg_advisory_xact_lock(hashtext($1))",
+                                 booking_lock_key(booking_date))
+                taken = await db.fetchval("""
+                    SELECT 1 FROM bookings
+                    WHERE booking_date = $1
+                      AND booking_time = $2
+                      AND service_id = $3
+                      AND status IN ('pending', 'paid')
+                """, booking_date, booking_time, fields["service_id"])
+                if taken:
+                    return api_response(request, {"error": "Slot già occupato"}, status_code=400)
+
+                booking_id = await db.fetchval("""
+                    INSERT INTO bookings
+                    (user_id, service_id, booking_date, booking_time, customer_name, customer_email, status)
+                    VALUES ($1, $2, $3, $4, $5, $6, 'pending')
+                    RETURNING id
+                """, user_id, fields["service_id"], booking_date, booking_time,
+                    fields["customer_name"], fields["customer_email"])
+            # Con REDIS_URL è una chiamata bloccante: fuori dall'event loop
+            await asyncio.to_thread(invalidate_booking_summary, user_id)
+
+            # 2. Creo sessione Stripe
+            try:
+                stripe_session = await stripe_create_checkout_session(
+                    payment_method_types=["card"],
+                    mode="payment",
+                    customer_email=fields["customer_email"],
+                    line_items=[booking_line_item(
+                        fields["service_name"], fields["service_price"])],
+                    success_url=external_url(environ, "booking_success") +
+                    "?session_id={CHECKOUT_SESSION_ID}",
+                    cancel_url=external_url(environ, "prenotazioni")
+                )
+            except (StripeAsyncError, httpx.HTTPError):
+                # Libero lo slot (l'indice unico non guarda lo status)
+                await db.execute("DELETE FROM bookings WHERE id = $1", booking_id)
+                await asyncio.to_thread(invalidate_booking_summary, user_id)
+                raise
+
+            # 3. Aggiorno la prenotazione con stripe_session_id
+            await db.execute(
+                "UPDATE bookings SET stripe_session_id = $1 WHERE id = $2",
+                stripe_session["id"], booking_id)
+
+            return api_response(request, {"session_id": stripe_session["id"]})
+
+        except asyncpg.exceptions.UniqueViolationError:
+            return api_response(request, {"error": "Slot già occupato"}, status_code=400)
+        except (StripeAsyncError, httpx.HTTPError) as e:
+            return api_response(request, {"error": f"Errore Stripe: {str(e)}"}, status_code=500)
+        except Exception as e:
+            return api_response(request, {"error": f"Errore server: {str(e)}"}, status_code=500)
+
+
+# ======================
+# APP ASGI
+# ======================
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global db_pool, stripe_client
+    db_pool = await asyncpg.create_pool(
+        flask_app.config["SQLALCHEMY_DATABASE_URI"], min_size=2, max_size=20)
+    stripe_client = httpx.AsyncClient(
+        base_url=STRIPE_API_URL, auth=(STRIPE_SECRET_KEY, ""), timeout=30)
+    try:
+        yield
+    finally:
+        await stripe_client.aclose()
+        await db_pool.close()
+
+
+application = Starlette(
+    routes=[
+        Route("/api/available_slots", available_slots, methods=["GET"]),
+        Route("/api/cart/add", add_to_cart, methods=["POST"]),
+        Route("/api/cart/update", update_cart, methods=["POST"]),
+        Route("/api/cart/remove", remove_from_cart, methods=["POST"]),
+        Route("/api/cart", get_cart_api, methods=["GET"]),
+        Route("/api/bookings/checkout", booking_checkout, methods=["POST"]),
+        # Pagine, template e API restanti: app Flask invariata
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
+
+
+# ======================
+# AVVIO
+# ======================
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi:application", host="127.0.0.1", port=8000)
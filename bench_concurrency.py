@@ -0,0 +1,146 @@
+"""
+Benchmark di concorrenza: modalità threaded (Flask) contro modalità ASGI.
+
+Avviare prima i due server:
+    python app.py                                    # threaded, porta 5000
+    uvicorn asgi:application --port 8000 --workers 1 # asyncio, porta 8000
+
+Poi:
+    python bench_concurrency.py --service-id 1 --date 2026-11-03
+
+Per ogni livello di concorrenza invia richieste parallele su entrambi i
+server e stampa throughput, latenze (p50/p99) ed errori: il punto in cui gli
+errori o la p99 esplodono è il limite di concorrenza della modalità.
+
+Scenari:
+- GET /api/available_slots e GET /api/cart: solo DB e sessione;
+- POST /api/bookings/checkout (--checkout): il caso che conta davvero, con
+  un INSERT e una chiamata HTTP a Stripe per richiesta. Ogni richiesta
+  prenota uno slot diverso a partire da --checkout-date (40 slot al giorno,
+  giorni successivi per le richieste oltre), con date distinte per i due
+  server. Crea prenotazioni vere: usare un DB di prova e una chiave Stripe
+  di test (sk_test_...) in config.py, mai quella di produzione.
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+from datetime import date, timedelta
+
+import httpx
+
+TARGETS = {
+    "threaded": "http://127.0.0.1:5000",
+    "asgi": "http://127.0.0.1:8000",
+}
+
+SLOTS_PER_DAY = 40
+
+
+async def run_level(base_url, send, concurrency, total):
+    """send(client) esegue una richiesta e restituisce la risposta."""
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await send(client)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "rps": total / elapsed,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+def checkout_sender(service_id, first_day):
+    """Richieste di checkout, ognuna su uno slot libero diverso."""
+    counter = itertools.count()
+
+    def send(client):
+        i = next(counter)
+        day = first_day + timedelta(days=i // SLOTS_PER_DAY)
+        minutes = 10 * 60 + (i % SLOTS_PER_DAY) * 15
+        return client.post("/api/bookings/checkout", json={
+            "service_id": service_id,
+            "service_name": "Benchmark",
+            "service_price": 1,
+            "booking_date": day.isoformat(),
+            "booking_time": f"{minutes // 60:02d}:{minutes % 60:02d}",
+            "customer_name": "Benchmark",
+            "customer_email": "benchmark@example.com",
+        })
+
+    return send
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--service-id", default="1")
+    parser.add_argument("--date", required=True)
+    parser.add_argument("--levels", default="1,8,32,128,512")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--checkout", action="store_true",
+                        help="misura anche POST /api/bookings/checkout (DB + Stripe)")
+    parser.add_argument("--checkout-date",
+                        help="primo giorno libero per le prenotazioni di benchmark")
+    args = parser.parse_args()
+
+    scenarios = [
+        ("/api/available_slots", lambda: (lambda client: client.get(
+            f"/api/available_slots?service_id={args.service_id}&date={args.date}"))),
+        ("/api/cart", lambda: (lambda client: client.get("/api/cart"))),
+    ]
+    if args.checkout:
+        if not args.checkout_date:
+            parser.error("--checkout richiede --checkout-date")
+        levels = list(map(int, args.levels.split(",")))
+        targets = args.targets.split(",")
+        first_day = date.fromisoformat(args.checkout_date)
+        days_per_run = -(-args.requests // SLOTS_PER_DAY)
+        # Ogni coppia (server, livello) prenota su giorni suoi: nessun conflitto
+        checkout_days = {
+            name: iter([first_day + timedelta(days=(t * len(levels) + d) * days_per_run)
+                        for d in range(len(levels))])
+            for t, name in enumerate(targets)
+        }
+        scenarios.append(("/api/bookings/checkout", None))
+
+    print(f"{'modalità':<10} {'endpoint':<24} {'conc':>5} {'req/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'errori':>7}")
+    for path, make_sender in scenarios:
+        for name in args.targets.split(","):
+            for level in map(int, args.levels.split(",")):
+                if make_sender is None:
+                    send = checkout_sender(int(args.service_id), next(checkout_days[name]))
+                else:
+                    send = make_sender()
+                r = await run_level(TARGETS[name], send, level, args.requests)
+                print(f"{name:<10} {path:<24} {level:>5} {r['rps']:>9.1f} "
+                      f"{r['p50']:>8.1f} {r['p99']:>8.1f} {r['errors']:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())